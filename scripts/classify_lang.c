@@ -0,0 +1,88 @@
+/*
+ * lrclib フィルタ用 SQLite ローダブル拡張: classify_lang(text) → 'ja' | 'ko' | 'en' | NULL
+ *
+ * filter_lyrics.py の classify_lang と同じ判定 (1パス走査 + 早期リターン) を C で行い、
+ * 言語フィルタを SELECT の WHERE 句に押し込む。除外行は Python に渡らない。
+ *
+ * タイムスタンプ ([mm:ss.xx]) の文字はどの文字種にも数えられないので、
+ * 生の synced_lyrics をそのまま渡してよい。
+ *
+ * Build:
+ *   gcc -O3 -march=native -fPIC -shared classify_lang.c -o classify_lang.so
+ */
+
+#include <sqlite3ext.h>
+SQLITE_EXTENSION_INIT1
+
+/* UTF-8 を1文字デコードして *pp を進める (不正バイトは1バイト1文字扱い) */
+static unsigned int next_cp(const unsigned char **pp, const unsigned char *end) {
+    const unsigned char *p = *pp;
+    unsigned int c = *p++;
+    int extra = 0;
+    if (c >= 0xF0) { c &= 0x07; extra = 3; }
+    else if (c >= 0xE0) { c &= 0x0F; extra = 2; }
+    else if (c >= 0xC0) { c &= 0x1F; extra = 1; }
+    while (extra-- > 0 && p < end && (*p & 0xC0) == 0x80) {
+        c = (c << 6) | (*p++ & 0x3F);
+    }
+    *pp = p;
+    return c;
+}
+
+static const char *classify(const unsigned char *p, int n) {
+    const unsigned char *end = p + n;
+    const unsigned char *q;
+    int chars = 0;
+    int ja = 0, ko = 0, latin = 0, exclude = 0;
+
+    for (q = p; q < end && chars < 30; chars++) {
+        next_cp(&q, end);
+    }
+    if (chars < 30) return 0;
+
+    while (p < end) {
+        unsigned int cp = next_cp(&p, end);
+        if (cp >= 0x3040 && cp <= 0x30FF) {
+            if (++ja >= 10) return "ja";
+        } else if (cp >= 0xAC00 && cp <= 0xD7AF) {
+            if (++ko >= 10) return "ko";
+        } else if ((cp >= 0x41 && cp <= 0x5A) || (cp >= 0x61 && cp <= 0x7A)
+                   || (cp >= 0xC0 && cp <= 0x24F)) {
+            latin++;
+        } else if ((cp >= 0x600 && cp <= 0x6FF) || (cp >= 0x400 && cp <= 0x4FF)
+                   || (cp >= 0x900 && cp <= 0x97F) || (cp >= 0xE00 && cp <= 0xE7F)) {
+            if (++exclude > 50) return 0;
+        }
+    }
+    return latin >= 30 ? "en" : 0;
+}
+
+static void classify_lang_func(sqlite3_context *ctx, int argc, sqlite3_value **argv) {
+    const unsigned char *text;
+    const char *lang;
+    (void)argc;
+
+    text = sqlite3_value_text(argv[0]);
+    if (text == 0) {
+        sqlite3_result_null(ctx);
+        return;
+    }
+    lang = classify(text, sqlite3_value_bytes(argv[0]));
+    if (lang == 0) {
+        sqlite3_result_null(ctx);
+    } else {
+        sqlite3_result_text(ctx, lang, -1, SQLITE_STATIC);
+    }
+}
+
+#ifdef _WIN32
+__declspec(dllexport)
+#endif
+int sqlite3_classifylang_init(sqlite3 *db, char **pzErrMsg, const sqlite3_api_routines *pApi) {
+    (void)pzErrMsg;
+    SQLITE_EXTENSION_INIT2(pApi);
+    return sqlite3_create_function_v2(
+        db, "classify_lang", 1,
+        SQLITE_UTF8 | SQLITE_DETERMINISTIC | SQLITE_INNOCUOUS,
+        0, classify_lang_func, 0, 0, 0);
+}
@@ -0,0 +1,95 @@
+"""
+pass 1 の行ごとのホットパス (品質チェック + dedup キー計算)
+
+ワーカーが import する関数だけをまとめたモジュール。
+"""
+
+import functools
+import re
+
+import xxhash
+
+# ============================================================
+# プリコンパイル済み正規表現
+# ============================================================
+
+_RE_TS = re.compile(r'\[[\d:.]+\]')
+_RE_TS_B = re.compile(rb'\[[\d:.]+\]')
+_RE_NON_WORD = re.compile(r'[^\w]')
+# フィンガープリント用の括弧書き (行をまたがない)
+_RE_PAREN = re.compile(r'[\(\（][^\)\）\n]*[\)\）]')
+_RE_PAREN_B = re.compile(rb'\([^)\n]*\)')  # ASCII のみのテキスト用
+# ASCII の非単語文字 (bytes.translate の削除対象)
+_ASCII_NON_WORD = bytes(c for c in range(0x80) if not re.match(r'\w', chr(c)))
+# str.strip() と同じ ASCII 空白文字 (\x1c-\x1f を含む)
+_ASCII_SPACE = bytes(c for c in range(0x80) if chr(c).isspace())
+_RE_FEAT = re.compile(r'\s*(feat|ft|with)\s+.*$', re.I)
+_RE_SYMBOL = re.compile(r'[^\w\s]')
+
+
+# ============================================================
+# 正規化・dedup キー
+# ============================================================
+
+@functools.lru_cache(maxsize=262144)
+def normalize_name(name: str) -> str:
+    """同一アーティストは何百曲も並ぶので結果をキャッシュする"""
+    # 括弧は _RE_SYMBOL が先に消すので、括弧書き除去のパスは持たない
+    n = _RE_SYMBOL.sub('', name.lower())
+    n = _RE_FEAT.sub('', n)
+    return ' '.join(n.split())
+
+
+def meta_key(artist: str, track: str, dur_bucket: int) -> bytes:
+    """メタデータ dedup キー: 正規化 artist + track + 30秒バケットの xxh3_128"""
+    key = f'{normalize_name(artist)}\t{normalize_name(track)}\t{dur_bucket}'
+    return xxhash.xxh3_128_digest(key.encode('utf-8'))
+
+
+def lyrics_fingerprint(text_no_ts: str | bytes) -> bytes:
+    """dedup 専用キー (暗号強度は不要)。xxh3_128 の16バイト生値を返す
+
+    text_no_ts: タイムスタンプ除去済みのテキスト (品質チェックで計算済み)。
+    bytes は ASCII のみの歌詞で、デコードせずそのまま処理する
+    """
+    if isinstance(text_no_ts, bytes):
+        data = _RE_PAREN_B.sub(b'', text_no_ts).translate(None, _ASCII_NON_WORD).lower()
+        return xxhash.xxh3_128_digest(data) if data else b''
+
+    text = _RE_PAREN.sub('', text_no_ts)
+    if text.isascii():
+        # ASCII のみなら bytes 上で削除 + 小文字化 (中間 str を作らない)
+        data = text.encode('ascii').translate(None, _ASCII_NON_WORD).lower()
+    else:
+        data = _RE_NON_WORD.sub('', text).lower().encode('utf-8')
+    if not data:
+        return b''
+    return xxhash.xxh3_128_digest(data)
+
+
+# ============================================================
+# 行ごとの判定
+# ============================================================
+
+def process_row(rid: int, artist: str, track: str, dur_bucket: int,
+                data: bytes, lang: str) -> tuple | None:
+    """1行を判定し surv 行 (id, lang, fp, meta, lines) を返す。品質NGなら None"""
+    # 1. 品質チェック (最も軽い処理を先に)。歌詞は UTF-8 の bytes で受け取る
+    # 本文長は除去・strip で増えず、文字数 <= バイト数なので、
+    # 生の長さで 100 未満なら正規表現を走らせる前に落とせる
+    newlines: int = data.count(b'\n')
+    if newlines < 9 or len(data) < 100:
+        return None
+    if data.isascii():
+        # ASCII (en の大半) は str を作らず bytes のまま処理する
+        text_no_ts = _RE_TS_B.sub(b'', data)
+        body_len = len(text_no_ts.strip(_ASCII_SPACE))
+    else:
+        text_no_ts = _RE_TS.sub('', data.decode('utf-8'))
+        body_len = len(text_no_ts.strip())
+    if body_len < 100:
+        return None
+
+    # 2. dedup キー (比較は pass 2 の SQL で行う)
+    return (rid, lang, lyrics_fingerprint(text_no_ts) or None,
+            meta_key(artist, track, dur_bucket), newlines + 1)
@@ -1,90 +1,257 @@
 #!/usr/bin/env python3
 """
-lrclib フィルタリングスクリプト (1パス・メモリ安全・高速化版)
+lrclib フィルタリングスクリプト (2パス・メモリ安全・高速化版)
 
 最適化:
-  - SQLプレフィルタ: duration >= 60
-  - 品質チェックを最初に (最も軽い処理)
-  - 言語判定: 1パス走査 + 早期リターン
-  - MD5 ハッシュ (SHA256の2-3倍速)
-  - ストリーミング処理 (全件メモリに載せない)
+  - SQLプレフィルタ: duration >= 60 + 言語判定 (C 拡張 UDF)
+  - 言語判定: C 拡張が無ければ NumPy ベクトル化版を UDF 登録
+  - xxh3_128 ハッシュ (MD5より1桁速い, 16バイト生値で保持)
+  - pass 1: (id, lang, fp, meta, lines) の小さな行だけを一時テーブルへ
+  - pass 1 の判定はコア数ぶんのワーカープロセスで並列 (id 範囲ごとに独立した読み取り接続)
+  - pass 1 の surv への書き込みは書き込みスレッドで行い、結果の受け取りと重ねる
+  - pass 2: dedup は SQL (UNIQUE + ウィンドウ関数)。Python に dedup 用の dict/set を持たない
+  - 出力は ATTACH + INSERT ... SELECT。歌詞本文は zstd 圧縮した BLOB で保存
   - 全正規表現プリコンパイル
+  - 行ごとのホットパスは filter_hot に分離
 
 Usage:
+    pip install xxhash zstandard numpy   # numpy は C 拡張を使わないときだけ必要
+    gcc -O3 -march=native -fPIC -shared classify_lang.c -o classify_lang.so
     python3 -u filter_lyrics.py <input.db> <output.db>
+
+出力形式:
+    lyrics (id, track_name, artist_name, album_name, duration, synced_lyrics, lang)
+    synced_lyrics は BLOB で、UTF-8 の LRC テキストを zstd で圧縮したフレーム
+    (1行1フレーム, 元サイズ入り)。Rust 版 filter-lrclib の出力 (TEXT) とは異なり、
+    sqlite3 CLI などでは本文を直接読めない。読むときは取り出して展開する:
+        zstandard.ZstdDecompressor().decompress(blob).decode('utf-8')
+    CLI なら: sqlite3 out.db "SELECT writefile('x.zst', synced_lyrics) FROM lyrics
+              WHERE id=1" && zstd -dc x.zst
 """
 
-import hashlib
-import re
+from __future__ import annotations
+
+import multiprocessing
+import os
+import queue
 import sqlite3
 import sys
+import threading
 import time
 
-# ============================================================
-# プリコンパイル済み正規表現
-# ============================================================
-
-_RE_TS = re.compile(r'\[[\d:.]+\]')
-_RE_PAREN = re.compile(r'[\(\（].*?[\)\）]')
-_RE_NON_WORD = re.compile(r'[^\w]')
-_RE_BRACKET = re.compile(r'\s*[\(\[（【].+?[\)\]）】]')
-_RE_FEAT = re.compile(r'\s*(feat|ft|with)\s+.*$', re.I)
-_RE_SYMBOL = re.compile(r'[^\w\s]')
+import zstandard
+
+from filter_hot import process_row
+
+# SQL は定数文字列にして sqlite3 のステートメントキャッシュを効かせる
+_SURV_SQL = 'INSERT OR IGNORE INTO surv VALUES (?,?,?,?,?)'
+# meta ごとに行数最大 (同数なら先の id) の1件だけを keep に残す
+_KEEP_SQL = '''
+    INSERT INTO keep
+    SELECT id, lang FROM (
+        SELECT id, lang,
+               ROW_NUMBER() OVER (PARTITION BY meta ORDER BY lines DESC, id) AS rn
+        FROM surv
+    ) WHERE rn = 1
+    ORDER BY id
+'''
+# 生き残りの行を SQLite 内で出力DBへコピー (歌詞本文は UTF-8 の bytes のまま圧縮 UDF へ)。
+# id 昇順に入れると rowid B-tree は末尾追記だけになりページ分割が起きない
+_COPY_SQL = '''
+    INSERT INTO dst.lyrics
+    SELECT l.id, l.track_name, l.artist_name, l.album_name, l.duration,
+           compress_lyrics(CAST(l.synced_lyrics AS BLOB)), k.lang
+    FROM temp.keep k JOIN main.lyrics l ON l.id = k.id
+    WHERE k.id BETWEEN ? AND ?
+    ORDER BY k.id
+'''
+# pass 1 のワーカー入力: id 範囲 [lo, hi] の候補行。
+# SQLプレフィルタ: duration < 60 と対象外言語を除外 (除外行は Python に渡らない)。
+# タイムスタンプは文字種判定に影響しないので生の歌詞をそのまま判定する。
+# dur_bucket は30秒単位の四捨五入 (duration >= 0 なので +15 して切り捨て)。
+# LIMIT -1 はサブクエリの平坦化を止め、classify_lang の二重評価を防ぐ
+_WINDOW_SQL = '''
+    SELECT * FROM (
+        SELECT id, artist_name, track_name,
+               CAST((COALESCE(duration, 0) + 15) / 30.0 AS INTEGER) AS dur_bucket,
+               CAST(synced_lyrics AS BLOB), classify_lang(synced_lyrics) AS lang
+        FROM lyrics
+        WHERE id BETWEEN ? AND ? AND (duration IS NULL OR duration >= 60)
+        LIMIT -1
+    ) WHERE lang IS NOT NULL
+'''
+_BATCH_SIZE = 50_000
+_QUEUE_DEPTH = 4       # 書き込みスレッドに積めるバッチ数
+_WINDOWS_PER_WORKER = 8  # ワーカー1つあたりの投入済み・未消費の窓数の上限
+_WINDOW_SIZE = 10_000  # 1タスクあたりの id 幅
+_COPY_SPAN = 200_000   # 出力コピー1トランザクションあたりの id 幅
+
+# 出力DB の PRAGMA。page_size はページ作成前 (CREATE TABLE より前) かつ WAL 化より
+# 前に設定する。WAL + synchronous=NORMAL なら異常終了しても出力DBは壊れない。
+# temp_store=MEMORY は最後の CREATE INDEX / ANALYZE のソートをメモリで行う。
+_OUTPUT_PRAGMAS = '''
+    PRAGMA page_size=65536;
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA locking_mode=EXCLUSIVE;
+    PRAGMA cache_size=-500000;
+'''
+
+# 出力の synced_lyrics は zstd 圧縮 (level 3)。歌詞1件は小さいのでスレッド圧縮はしない
+_ZSTD_LEVEL = 3
+
+# C 拡張 classify_lang (scripts/classify_lang.c をビルドした共有ライブラリ)
+_EXT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'classify_lang')
 
 
 # ============================================================
-# 正規化・判定関数
+# 言語判定 (C 拡張が無いときの UDF)
 # ============================================================
 
-def normalize_name(name: str) -> str:
-    n = _RE_SYMBOL.sub('', name.lower())
-    n = _RE_BRACKET.sub('', n)
-    n = _RE_FEAT.sub('', n)
-    return ' '.join(n.split())
+# NumPy はフォールバック時だけ import する (register_classify_lang)
+np = None
 
 
-def lyrics_fingerprint(synced_lyrics: str) -> str:
-    text = _RE_TS.sub('', synced_lyrics)
-    text = _RE_PAREN.sub('', text)
-    text = _RE_NON_WORD.sub('', text).lower()
-    if not text:
-        return ''
-    return hashlib.md5(text.encode('utf-8')).hexdigest()
+def _nth_index(mask: np.ndarray, n: int) -> int | None:
+    """mask 中 n 番目の True の位置 (n 件未満なら None)"""
+    idx = np.flatnonzero(mask)
+    return int(idx[n - 1]) if idx.size >= n else None
+
+
+def _in_range(a: np.ndarray, lo: int, hi: int) -> np.ndarray:
+    return (a >= lo) & (a <= hi)
 
 
 def classify_lang(text_no_ts: str) -> str | None:
-    """1パス走査 + 早期リターンの言語判定"""
+    """NumPy ベクトル化の言語判定 (逐次走査の早期リターンと同じ結果)"""
     if len(text_no_ts) < 30:
         return None
 
-    ja = ko = latin = exclude = 0
-    for c in text_no_ts:
-        cp = ord(c)
-        if 0x3040 <= cp <= 0x309F or 0x30A0 <= cp <= 0x30FF:
-            ja += 1
-            if ja >= 10:
-                return 'ja'
-        elif 0xAC00 <= cp <= 0xD7AF:
-            ko += 1
-            if ko >= 10:
-                return 'ko'
-        elif (0x41 <= cp <= 0x5A or 0x61 <= cp <= 0x7A
-              or 0x00C0 <= cp <= 0x024F):
-            latin += 1
-        elif (0x0600 <= cp <= 0x06FF or 0x0400 <= cp <= 0x04FF
-              or 0x0900 <= cp <= 0x097F or 0x0E00 <= cp <= 0x0E7F):
-            exclude += 1
-            if exclude > 50:
-                return None
-    if exclude > 50 and exclude > latin:
-        return None
-    if latin >= 30:
-        return 'en'
-    return None
+    # ASCII のみなら ja/ko/exclude は 0 件。1文字1バイトで数える
+    if text_no_ts.isascii():
+        a = np.frombuffer(text_no_ts.encode('ascii'), dtype=np.uint8)
+        latin = np.count_nonzero(_in_range(a, 0x41, 0x5A) | _in_range(a, 0x61, 0x7A))
+        return 'en' if latin >= 30 else None
+
+    a = np.frombuffer(text_no_ts.encode('utf-32-le'), dtype=np.uint32)
+    ja = _in_range(a, 0x3040, 0x30FF)
+    ko = _in_range(a, 0xAC00, 0xD7AF)
+    exclude = (_in_range(a, 0x0600, 0x06FF) | _in_range(a, 0x0400, 0x04FF)
+               | _in_range(a, 0x0900, 0x097F) | _in_range(a, 0x0E00, 0x0E7F))
+
+    # 閾値に最も早く到達したものが勝つ (ja/ko: 10文字, exclude: 51文字)
+    hits = [(pos, lang) for mask, n, lang in ((ja, 10, 'ja'), (ko, 10, 'ko'), (exclude, 51, None))
+            if (pos := _nth_index(mask, n)) is not None]
+    if hits:
+        return min(hits, key=lambda h: h[0])[1]
+
+    latin = np.count_nonzero(_in_range(a, 0x41, 0x5A) | _in_range(a, 0x61, 0x7A)
+                             | _in_range(a, 0x00C0, 0x024F))
+    return 'en' if latin >= 30 else None
+
+
+def register_classify_lang(con: sqlite3.Connection) -> bool:
+    """classify_lang を SQL 関数として登録する。C 拡張を読めたら True"""
+    try:
+        con.enable_load_extension(True)
+        try:
+            con.load_extension(_EXT_PATH)
+        finally:
+            # 読み込みに失敗しても拡張ロードを開けたままにしない
+            con.enable_load_extension(False)
+        return True
+    except (AttributeError, sqlite3.OperationalError):
+        # 拡張未ビルド / 拡張読み込み非対応の Python では NumPy 版で代用
+        global np
+        import numpy as np
+        con.create_function('classify_lang', 1, classify_lang, deterministic=True)
+        return False
 
 
 # ============================================================
-# メイン: 1パスストリーミング処理
+# pass 1 ワーカー: id 窓ごとに品質チェック + dedup キー計算
+# ============================================================
+
+_worker_src: sqlite3.Connection | None = None
+
+
+def _init_worker(input_db: str) -> None:
+    """ワーカーごとに入力DBの読み取り接続を開く (カーソルは共有しない)"""
+    global _worker_src
+    _worker_src = sqlite3.connect(input_db)
+    _worker_src.execute('PRAGMA mmap_size=4294967296;')
+    register_classify_lang(_worker_src)
+
+
+def _gated(windows: list[tuple[int, int]], in_flight: threading.Semaphore,
+           stop: threading.Event):
+    """in_flight を取れた窓だけ imap に渡す
+
+    imap は投入側スレッドで入力を先読みし、結果も無制限に溜めるので、
+    受け取り側が release するまで投入を止めて未消費の結果を抑える
+    """
+    for w in windows:
+        in_flight.acquire()
+        if stop.is_set():
+            return
+        yield w
+
+
+def filter_window(window: tuple[int, int]) -> tuple[int, int, list[tuple]]:
+    """id 範囲の候補行を判定し (候補件数, 品質NG件数, surv 行) を返す"""
+    rows = _worker_src.execute(_WINDOW_SQL, window).fetchall()
+    out = [r for row in rows if (r := process_row(*row)) is not None]
+    return len(rows), len(rows) - len(out), out
+
+
+# ============================================================
+# 書き込み: executemany バッチ
+# ============================================================
+
+def _flush_batch(src: sqlite3.Connection, batch: list[tuple]) -> int:
+    """pass 1 の結果を surv に executemany する。fp 重複で無視した件数を返す"""
+    inserted = src.executemany(_SURV_SQL, batch).rowcount
+    ignored = len(batch) - inserted
+    batch.clear()
+    return ignored
+
+
+def _surv_writer(src: sqlite3.Connection, q: queue.Queue, stats: dict) -> None:
+    """キューのバッチを surv に書き込む。None で終了
+
+    sqlite3 は step() 中に GIL を手放すので、書き込みと結果の受け取りが重なる。
+    失敗しても読み捨てを続け、メインスレッドが put で詰まらないようにする
+    """
+    while (batch := q.get()) is not None:
+        if 'error' not in stats:
+            try:
+                stats['fp_dedup'] += _flush_batch(src, batch)
+            except Exception as e:
+                stats['error'] = e
+
+
+def register_lyrics_codec(con: sqlite3.Connection) -> None:
+    """compress_lyrics / decompress_lyrics を SQL 関数として登録する
+
+    このスクリプトが開く接続だけで使える。他のツールからの読み方はモジュール docstring 参照
+    """
+    cctx = zstandard.ZstdCompressor(level=_ZSTD_LEVEL)
+    dctx = zstandard.ZstdDecompressor()
+    con.create_function('compress_lyrics', 1, cctx.compress, deterministic=True)
+    con.create_function('decompress_lyrics', 1,
+                        lambda b: dctx.decompress(b).decode('utf-8'), deterministic=True)
+
+
+def _open_output(output_db: str) -> sqlite3.Connection:
+    dst = sqlite3.connect(output_db)
+    dst.executescript(_OUTPUT_PRAGMAS)
+    register_lyrics_codec(dst)
+    return dst
+
+
+# ============================================================
+# メイン: 2パス処理 (pass 1: Python で判定, pass 2: SQL で dedup)
 # ============================================================
 
 def main():
@@ -97,89 +264,114 @@ def main():
     print(f"Output: {output_db}")
 
     # --- 入力DB ---
-    src = sqlite3.connect(input_db)
+    # pass 1 の間だけ書き込みスレッドが使う (その間メインスレッドは触らない)
+    src = sqlite3.connect(input_db, check_same_thread=False)
     src.execute('PRAGMA mmap_size=4294967296;')
     src.execute('PRAGMA cache_size=-1000000;')
-    total = src.execute('SELECT COUNT(*) FROM lyrics').fetchone()[0]
+    native = register_classify_lang(src)
+    print(f"classify_lang: {'C extension' if native else 'Python UDF'}")
+    total, candidates = src.execute(
+        'SELECT COUNT(*), TOTAL(duration IS NULL OR duration >= 60) FROM lyrics'
+    ).fetchone()
     print(f"Total records: {total:,}")
 
     # --- 出力DB ---
-    dst = sqlite3.connect(output_db)
-    dst.execute('PRAGMA synchronous=OFF;')
-    dst.execute('PRAGMA journal_mode=OFF;')
-    dst.execute('PRAGMA cache_size=-500000;')
+    # スキーマだけ作って閉じる (EXCLUSIVE ロックを pass 2 の ATTACH のために解放)
+    dst = _open_output(output_db)
     dst.execute('''CREATE TABLE lyrics (
         id INTEGER PRIMARY KEY, track_name TEXT NOT NULL,
         artist_name TEXT NOT NULL, album_name TEXT,
-        duration REAL, synced_lyrics TEXT NOT NULL, lang TEXT NOT NULL
+        duration REAL, synced_lyrics BLOB NOT NULL, lang TEXT NOT NULL
     )''')
+    dst.close()
 
-    # --- 1パス処理 ---
-    meta_seen: dict[tuple, tuple[int, int]] = {}  # key → (id, line_count)
-    fp_seen: set[str] = set()
+    # --- pass 1: 品質チェック + fp/meta キー計算 → 一時テーブル surv ---
+    # dedup 状態は Python の dict/set ではなく SQLite の B-tree に置く。
+    # fp の UNIQUE + INSERT OR IGNORE で、id 順に最初に現れた行だけが残る。
+    # temp はディスク上に置き、キャッシュ上限 (500MB) を超えた分は一時ファイルへ
+    # 逃がす (temp の cache_size は main と別で、既定は 2MB しかない)
+    src.executescript('''
+        PRAGMA temp_store=FILE;
+        PRAGMA temp.cache_size=-500000;
+    ''')
+    src.execute('''CREATE TEMP TABLE surv (
+        id INTEGER PRIMARY KEY, lang TEXT NOT NULL, fp BLOB UNIQUE,
+        meta BLOB NOT NULL, lines INTEGER NOT NULL
+    )''')
 
     stats = {'quality': 0, 'lang': 0, 'fp_dedup': 0, 'meta_dedup': 0, 'kept': 0}
     t0 = time.time()
 
-    # SQLプレフィルタ: duration < 60 を除外
-    cursor = src.execute(
-        'SELECT id, track_name, artist_name, album_name, duration, synced_lyrics '
-        'FROM lyrics WHERE duration IS NULL OR duration >= 60'
-    )
-
-    dst.execute('BEGIN')
-    for i, (rid, track, artist, album, dur, lyrics) in enumerate(cursor):
-        if (i + 1) % 500_000 == 0:
-            elapsed = time.time() - t0
-            print(f"  {i+1:>10,} / {total:,}  {i+1/elapsed:.0f}/s  kept={stats['kept']:,}")
-
-        # 1. 品質チェック (最も軽い処理を先に)
-        if lyrics.count('\n') < 9:
-            stats['quality'] += 1
-            continue
-        text_no_ts = _RE_TS.sub('', lyrics)
-        if len(text_no_ts.strip()) < 100:
-            stats['quality'] += 1
-            continue
-
-        # 2. 言語判定 (早期リターンで高速)
-        lang = classify_lang(text_no_ts)
-        if lang is None:
-            stats['lang'] += 1
-            continue
-
-        # 3. 歌詞フィンガープリント dedup (グローバル)
-        fp = lyrics_fingerprint(lyrics)
-        if fp:
-            if fp in fp_seen:
-                stats['fp_dedup'] += 1
-                continue
-            fp_seen.add(fp)
-
-        # 4. メタデータ dedup
-        meta_key = (normalize_name(artist), normalize_name(track), round((dur or 0) / 30))
-        line_count = lyrics.count('\n') + 1
-
-        if meta_key in meta_seen:
-            prev_id, prev_lines = meta_seen[meta_key]
-            if line_count <= prev_lines:
-                stats['meta_dedup'] += 1
-                continue
-            dst.execute('DELETE FROM lyrics WHERE id=?', (prev_id,))
-            stats['meta_dedup'] += 1
-            stats['kept'] -= 1
-
-        meta_seen[meta_key] = (rid, line_count)
-        dst.execute('INSERT INTO lyrics VALUES (?,?,?,?,?,?,?)',
-                    (rid, track, artist, album, dur, lyrics, lang))
-        stats['kept'] += 1
-
-        # 定期コミット (メモリ節約)
-        if stats['kept'] % 100_000 == 0:
-            dst.execute('COMMIT')
-            dst.execute('BEGIN')
-
-    dst.execute('COMMIT')
+    # CPU 律速の判定はコア数ぶんのワーカープロセスで並列に行う。
+    # imap は id 窓の順に結果を返すので、fp は従来どおり id 順に最初の行が残る
+    # cpu_count() は環境によって None を返す
+    n_workers = os.cpu_count() or 1
+    lo, hi = src.execute('SELECT MIN(id), MAX(id) FROM lyrics').fetchone()
+    windows = [] if lo is None else [(w, w + _WINDOW_SIZE - 1)
+                                    for w in range(lo, hi + 1, _WINDOW_SIZE)]
+    # surv への executemany は書き込みスレッドに渡し、メインスレッドは受け取りだけ。
+    # キューは FIFO なので書き込みも id 順のまま。スレッドはワーカーの fork 後に起こす。
+    # メモリは未消費の窓 (in_flight) + キューのバッチ数で抑える
+    q: queue.Queue = queue.Queue(maxsize=_QUEUE_DEPTH)
+    writer = threading.Thread(target=_surv_writer, args=(src, q, stats))
+    in_flight = threading.Semaphore(n_workers * _WINDOWS_PER_WORKER)
+    stop = threading.Event()
+    batch: list[tuple] = []
+    i = 0
+    with multiprocessing.Pool(n_workers, initializer=_init_worker,
+                              initargs=(input_db,)) as pool:
+        writer.start()
+        try:
+            results = pool.imap(filter_window, _gated(windows, in_flight, stop), chunksize=4)
+            for seen, quality, rows in results:
+                in_flight.release()
+                if 'error' in stats:
+                    # 書き込みが失敗したら残りの窓は捨てる (with を抜けるとワーカーは terminate)
+                    break
+                if (i + seen) // 500_000 > i // 500_000:
+                    elapsed = time.time() - t0
+                    print(f"  {i + seen:>10,} / {total:,}  {(i + seen)/elapsed:.0f}/s")
+                i += seen
+                stats['quality'] += quality
+                batch.extend(rows)
+                if len(batch) >= _BATCH_SIZE:
+                    q.put(batch)
+                    batch = []
+            else:
+                q.put(batch)
+        finally:
+            # 投入側スレッドが acquire で止まっていれば起こして終わらせる
+            stop.set()
+            in_flight.release()
+            q.put(None)
+            writer.join()
+    if 'error' in stats:
+        raise stats.pop('error')
+    src.commit()
+    stats['lang'] = int(candidates) - i
+    surv_count = src.execute('SELECT COUNT(*) FROM surv').fetchone()[0]
+
+    # --- pass 2: meta dedup (行数最大, 同数なら先の id) を SQL で行い出力DBへ ---
+    src.execute('CREATE TEMP TABLE keep (id INTEGER PRIMARY KEY, lang TEXT NOT NULL)')
+    src.execute(_KEEP_SQL)
+    src.execute('DROP TABLE surv')
+    src.commit()
+
+    # ATTACH + INSERT ... SELECT で行コピーは SQLite 内で完結させる (Python に戻るのは
+    # 歌詞本文の圧縮 UDF だけ)。
+    # id 幅ごとにコミットして WAL を自動チェックポイントさせ、肥大化を防ぐ
+    register_lyrics_codec(src)
+    src.execute('ATTACH DATABASE ? AS dst', (output_db,))
+    src.executescript('''
+        PRAGMA dst.synchronous=NORMAL;
+        PRAGMA dst.cache_size=-500000;
+        PRAGMA cache_spill=0;
+    ''')
+    for w in ([] if lo is None else range(lo, hi + 1, _COPY_SPAN)):
+        stats['kept'] += src.execute(_COPY_SQL, (w, w + _COPY_SPAN - 1)).rowcount
+        src.commit()
+    src.execute('DETACH DATABASE dst')
+    stats['meta_dedup'] = surv_count - stats['kept']
     elapsed = time.time() - t0
 
     print(f"\nFiltering done in {elapsed:.1f}s")
@@ -189,6 +381,9 @@ def main():
     # --- インデックス ---
     print("Building indexes...")
     t1 = time.time()
+    dst = _open_output(output_db)
+    # インデックス構築のソートは temp_store=MEMORY + 大きめのキャッシュで行う
+    dst.execute('PRAGMA cache_size=-2000000;')
     dst.execute('CREATE INDEX idx_artist_track ON lyrics(artist_name, track_name)')
     dst.execute('CREATE INDEX idx_lang ON lyrics(lang)')
     dst.execute('ANALYZE')